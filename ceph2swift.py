@@ -1,12 +1,25 @@
 #!/usr/bin/env python
-import arrow
 import argparse
 import boto
 import boto.s3.connection
+import hashlib
+import logging
 import os
 import signal
 import sys
+import threading
 import time
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+                                as_completed, wait)
+from io import BytesIO
+from six.moves import queue
+from tqdm import tqdm
+
+MB = 1024 * 1024
+SEPARATOR = '-' * 80
+BANNER = '*' * 80
+
+logger = logging.getLogger(__name__)
 
 
 class EnvDefault(argparse.Action):
@@ -23,11 +36,21 @@ class EnvDefault(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            '{} is not a positive integer'.format(value))
+    return number
+
+
+class FilterSkip(Exception):
+    """Raised by a stage to drop the current item from the pipeline."""
+
+
 class Stage(object):
-    items = None
 
-    def __init__(self, items=None, **kwargs):
-        self.items = items
+    def __init__(self, **kwargs):
         self.config = kwargs
 
     def configure(self, **kwargs):
@@ -42,60 +65,101 @@ class Stage(object):
     def after_process(self):
         pass
 
-    def __iter__(self):
-        self.before_process()
-        for item in self.items:
-            try:
-                yield self.process(item)
-            except AssertionError as ex:
-                print("SKIPPED: {}".format(ex.message))
-            except Exception as error:
-                print("ERROR: {}".format(error))
-        self.after_process()
-
 
 class Pipeline(object):
     items = None
+    stages = None
+    _fns = None
     start_time = 0
+    item_count = 0
     exit = False
 
     def __init__(self, items, *stages, **kwargs):
         self.items = items
+        self.stages = []
+        self._fns = []
         self.config = kwargs
         for stage in stages:
             stage.configure(**kwargs)
             self.add(stage)
 
     def add(self, stage):
-        stage.items = self.items
-        self.items = stage
+        self.stages.append(stage)
+        self._fns.append(stage.process)
 
     def before_process(self):
         self.start_time = time.time()
+        self.item_count = 0
+        for stage in self.stages:
+            stage.before_process()
 
     def after_process(self):
-        print("*"*80)
+        print(BANNER)
+        for stage in self.stages:
+            stage.after_process()
+        print("{} item(s) processed.".format(self.item_count))
         print("Time elapsed: {}".format(time.time() - self.start_time))
-        pass
 
-    def __call__(self):
+    def _run_stages(self, item):
+        """
+        Run a single item through every stage. Items flow independently so
+        this can be called concurrently from the worker threads.
+        A stage returning None or raising FilterSkip drops the item, any other
+        error is logged and raised.
+        :return: True if the item made it through all the stages.
+        """
+        name = item.name
+        try:
+            for fn in self._fns:
+                item = fn(item)
+                if item is None:
+                    return False
+        except FilterSkip as ex:
+            logger.debug('%s skipped: %s', name, ex)
+            return False
+        except Exception as ex:
+            logger.error('%s failed: %s', name, ex)
+            raise
+        return True
+
+    def _collect(self, futures):
+        for future in futures:
+            if future.result():
+                self.item_count += 1
+
+    def __call__(self, workers=16):
+        """
+        Drain the source items into a pool of workers.
+        At most 2 * workers items are in flight so the source generator is
+        consumed at the same pace the items are processed.
+        An error in a stage stops the pipeline once the items in flight are
+        done, the summaries are still reported.
+        :param workers: number of worker threads.
+        """
         self.before_process()
-        for _ in self.items:
-            pass
-        self.after_process()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = set()
+        try:
+            for item in self.items:
+                pending.add(executor.submit(self._run_stages, item))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    self._collect(done)
+            self._collect(as_completed(pending))
+        finally:
+            executor.shutdown()
+            self.after_process()
 
 
 class PrintFileInfo(Stage):
 
     def process(self, item):
-        print('-'*80)
-        print(item.name)
-        print("SRC MD5: {}".format(item.etag[1:-1]))
+        logger.debug(SEPARATOR)
+        logger.debug(item.name)
+        logger.debug('SRC MD5: %s', item.etag[1:-1])
         return item
 
-    def after_process(self):
-        print("*"*80)
-
 
 class Filter(Stage):
 
@@ -106,12 +170,52 @@ class Filter(Stage):
 
     def process(self, item):
         if self.filter(item):
-            raise RuntimeError("by {} filter.".format(self.name))
+            return None
         return item
 
 
+class BucketIndex(object):
+    """
+    Folders and files of a bucket loaded with a single listing. main passes
+    it to the source generator and to the stages writing to that bucket,
+    the folders created by the pipeline are added to the folders set.
+    """
+    folders = None
+    files = None
+
+    def __init__(self, bucket):
+        """
+        :param bucket: boto bucket to index.
+        """
+        self.bucket = bucket
+        self.folders = set()
+        self.files = dict()
+
+    def load(self):
+        # The progress bar is only drawn when attached to a terminal.
+        keys = tqdm(self.bucket.list(), desc='Preloading', unit=' keys',
+                    disable=not sys.stderr.isatty())
+        for key in keys:
+            if _exit_signal:
+                logger.warning('User interrupted preload.')
+                sys.exit(0)
+            # Folders are detected by the name ending with /, the listing
+            # doesn't include the content type.
+            if key.name.endswith('/'):
+                self.folders.add(key.name)
+                continue
+            self.files[key.name] = (key.etag[1:-1], key.size,
+                                    key.last_modified)
+        keys.close()
+        logger.info('%s folder(s) and %s file(s) loaded.',
+                    len(self.folders), len(self.files))
+        return self
+
+
 class S3Stage(Stage):
 
+    _bucket = None
+
     @property
     def connection(self):
         try:
@@ -126,12 +230,11 @@ class S3Stage(Stage):
         except ValueError:
             raise RuntimeError('S3Stage: tenant name not configured.')
 
-    @property
-    def bucket(self):
-        try:
-            return self.connection.get_bucket(self.bucket_name)
-        except Exception as ex:
-            raise ex
+    def before_process(self):
+        # Skip the HEAD request validating the bucket, a missing bucket will
+        # make the first request fail anyway.
+        self._bucket = self.connection.get_bucket(self.bucket_name,
+                                                  validate=False)
 
 
 class S3CreateFolderStructure(S3Stage):
@@ -144,57 +247,51 @@ class S3CreateFolderStructure(S3Stage):
     def __init__(self, existing_folders=None, **kwargs):
         """
         This stage will try to create parent folders that do not exist.
-        Preloaded existing folders can be passed down
-        :param existing_folders: Pre loaded existing folder list or set.
-        :param soft_folder_discovery: Use end / to detect folders else it will
-            use the mime type
+        Preloaded existing folders can be passed down, else the whole bucket
+        is listed in before_process. Pass the folders of the BucketIndex
+        already loaded for the other stages to avoid listing it again.
+        Safe to use from multiple threads, folders are reserved in
+        existing_folders before being created.
+        :param existing_folders: Pre loaded existing folder set.
         :param preload_folders: If set to False we won't pre load folders.
             default: True
         :param kwargs: keyword arguments passed down to parent constructor.
         """
         super(S3CreateFolderStructure, self).__init__(**kwargs)
         self.existing_folders = existing_folders
-
-    def load_existing_folders(self):
-        existing_folders = set()
-        print('Preloading existing folders ')
-        for key in self.bucket.list():
-            # Soft folder discovery is based on the folder name ending with /
-            if self.config.get('soft_folder_discovery'):
-                if key.name.endswith('/'):
-                    existing_folders.add(key.name)
-                continue
-            # Else check the mime type (the real deal)
-            key = self.bucket.get_key(key.name)
-            if key.content_type == self.content_type:
-                existing_folders.add(key.name)
-
-        print('{} folders loaded.'.format(len(existing_folders)))
-        return existing_folders
+        self._lock = threading.Lock()
 
     def sub_folders(self, filename):
-        folders = filename.split('/')[:-1]
-        current_path = ''
-        for folder in folders:
-            current_path = current_path + folder + '/'
-            yield current_path
-
-    def create_folder(self, path, item):
+        """
+        List the parent folders of filename, a/b/c returns ['a/', 'a/b/'].
+        """
+        folders = []
+        path = ''
+        for folder in filename.split('/')[:-1]:
+            path += folder + '/'
+            folders.append(path)
+        return folders
+
+    def create_folder(self, path, last_modified):
         try:
-            key = self.bucket.new_key(path)
+            key = self._bucket.new_key(path)
             key.content_type = self.content_type
-            key.set_metadata(self.last_modified,
-                             arrow.get(item.last_modified).isoformat())
+            key.set_metadata(self.last_modified, last_modified)
             key.set_contents_from_string('')
-            self.existing_folders.add(path)
-            print(path)
-        except Exception as e:
-            print("{}: {}".format(path, e.message))
+            logger.debug('Folder created: %s', path)
+        except Exception:
+            with self._lock:
+                self.existing_folders.discard(path)
+            raise
 
     def before_process(self):
-        if not self.existing_folders and \
-                self.config.get('preload_folders', True):
-            self.existing_folders = self.load_existing_folders()
+        super(S3CreateFolderStructure, self).before_process()
+        if self.existing_folders is None:
+            if self.config.get('preload_folders', True):
+                self.existing_folders = BucketIndex(
+                    self._bucket).load().folders
+            else:
+                self.existing_folders = set()
         self.start_folder_count = len(self.existing_folders)
 
     def after_process(self):
@@ -202,50 +299,241 @@ class S3CreateFolderStructure(S3Stage):
             len(self.existing_folders) - self.start_folder_count))
 
     def process(self, item):
-        print('FOLDERS:')
-        for folder in self.sub_folders(item.name):
-            if folder in self.existing_folders:
-                continue
-            self.create_folder(folder, item)
+        with self._lock:
+            missing = set(self.sub_folders(item.name)).difference(
+                self.existing_folders)
+            self.existing_folders.update(missing)
+        for folder in sorted(missing):
+            self.create_folder(folder, item.last_modified)
         return item
 
 
 class S3UploadFile(S3Stage):
 
     last_modified = 'x-last-modified'
+    multipart_threshold = 16 * MB
+    part_size = 10 * MB
+    max_parts = 10000
+    part_workers = 8
+    max_parts_in_memory = 32
+    max_copy_size = 5 * 1024 * MB
+    copy_part_size = 512 * MB
     key_count = 0
     existing_files = None
 
     def __init__(self, existing_files=None, **kwargs):
         """
         Upload file to destination bucket.
-        You can pass a pre loaded files dictionary to easy md5 verification.
-        :param existing_files: dict containing file key and etag.
+        The existence check is a lookup on the pre loaded files dictionary,
+        no request is sent to the destination bucket.
+        Files bigger than multipart_threshold are streamed with a multipart
+        upload, the parts waiting to be uploaded by all the workers are
+        limited to max_parts_in_memory.
+        :param existing_files: dict containing file key and
+            (etag, size, last_modified).
+        :param server_side_copy: Copy the keys within the destination endpoint
+            instead of downloading them, the destination connection must be
+            able to read the source bucket. default: False
         :param kwargs:
         """
         super(S3UploadFile, self).__init__(**kwargs)
+        if existing_files is None:
+            raise RuntimeError('S3UploadFile: existing files not configured.')
         self.existing_files = existing_files
+        self._lock = threading.Lock()
+        self._parts_in_memory = threading.BoundedSemaphore(
+            self.max_parts_in_memory)
 
-    def process(self, item):
-        if self.existing_files:
-            key_md5 = self.existing_files.get(item.name)
-        else:
-            key = self.bucket.get_key(item.name)
-            key_md5 = not key or key.etag[1:-1]
-        assert item.etag[1:-1] != key_md5, "File already exists."
-
-        key = self.bucket.new_key(item.name)
-        key.set_metadata(self.last_modified,
-                         arrow.get(item.last_modified).isoformat())
+    def parts_count(self, size):
+        """
+        Number of parts of the destination copy of a file of size, 1 when it
+        is sent in a single request.
+        """
+        if self.config.get('server_side_copy'):
+            if size < self.max_copy_size:
+                return 1
+            return -(-size // self.multipart_copy_part_size(size))
+        if size < self.multipart_threshold:
+            return 1
+        return -(-size // self.multipart_part_size(size))
+
+    def is_copied(self, item):
+        """
+        Check existing_files for a copy of item.
+        A multipart etag is not the md5 of the file, a multipart copy of a
+        single part source is accepted when the size and part count match
+        and it was written after the source was last modified.
+        """
+        try:
+            dst_etag, dst_size, dst_modified = self.existing_files[item.name]
+        except KeyError:
+            return False
+        src_etag = item.etag[1:-1]
+        if dst_etag == src_etag:
+            return True
+        if '-' in src_etag or '-' not in dst_etag or dst_size != item.size:
+            return False
+        # Both listings return last_modified as ISO 8601 UTC strings.
+        if dst_modified < item.last_modified:
+            return False
+        return dst_etag.rsplit('-', 1)[1] == str(self.parts_count(item.size))
+
+    def upload(self, item, metadata):
+        key = self._bucket.new_key(item.name)
+        key.update_metadata(metadata)
+        # boto sets the etag returned by the PUT response on the key.
         key.set_contents_from_string(item.get_contents_as_string())
+        return key.etag[1:-1]
+
+    def multipart_part_size(self, size):
+        """
+        Part size used for a file of size, part_size unless the file needs
+        more than max_parts parts.
+        """
+        return max(self.part_size, -(-size // self.max_parts))
+
+    def read_part(self, item, part_size):
+        """
+        Read the next part of item once there is room for it in memory. The
+        room is given back when the part is uploaded or at the end of file.
+        """
+        self._parts_in_memory.acquire()
+        try:
+            chunk = item.read(part_size)
+        except Exception:
+            self._parts_in_memory.release()
+            raise
+        if not chunk:
+            self._parts_in_memory.release()
+        return chunk
+
+    def release_part(self, future):
+        self._parts_in_memory.release()
+
+    def multipart_upload(self, item, metadata):
+        """
+        Stream the source key in parts of multipart_part_size. Parts are
+        uploaded by a pool of part_workers while the next ones are being
+        downloaded, at most part_workers parts of a file are uploaded at once.
+        The md5 of the file is computed while streaming, the etag returned by
+        the upload is checked against the one expected from the parts md5.
+        :return: md5 of the file, None if the destination etag doesn't match.
+        """
+        part_size = self.multipart_part_size(item.size)
+        mp = self._bucket.initiate_multipart_upload(item.name,
+                                                    metadata=metadata)
+        try:
+            executor = ThreadPoolExecutor(max_workers=self.part_workers)
+            pending = set()
+            part_num = 0
+            file_md5 = hashlib.md5()
+            parts_md5 = []
+            try:
+                chunk = self.read_part(item, part_size)
+                while chunk:
+                    part_num += 1
+                    file_md5.update(chunk)
+                    parts_md5.append(hashlib.md5(chunk).digest())
+                    future = executor.submit(mp.upload_part_from_file,
+                                             BytesIO(chunk), part_num)
+                    future.add_done_callback(self.release_part)
+                    pending.add(future)
+                    if len(pending) >= self.part_workers:
+                        done, pending = wait(pending,
+                                             return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    chunk = self.read_part(item, part_size)
+                for future in as_completed(pending):
+                    future.result()
+            except Exception:
+                # Drop the connection instead of reading the rest of the key.
+                item.close(fast=True)
+                raise
+            else:
+                item.close()
+            finally:
+                executor.shutdown()
+            dst_etag = mp.complete_upload().etag[1:-1]
+        except Exception:
+            mp.cancel_upload()
+            raise
+
+        # S3 multipart etag: md5 of the concatenated parts md5, part count.
+        expected_etag = '{}-{}'.format(
+            hashlib.md5(b''.join(parts_md5)).hexdigest(), len(parts_md5))
+        if dst_etag != expected_etag:
+            logger.warning('%s: destination etag doesn\'t match the parts.',
+                           item.name)
+            return None
+        return file_md5.hexdigest()
+
+    def multipart_copy_part_size(self, size):
+        """
+        Part size used to copy a file of size, copy_part_size unless the file
+        needs more than max_parts parts.
+        """
+        return max(self.copy_part_size, -(-size // self.max_parts))
 
-        key = self.bucket.get_key(item.name)
+    def copy(self, item, metadata):
+        """
+        Server side copy, the data doesn't go through this host. Keys bigger
+        than max_copy_size are copied in parts of multipart_copy_part_size by
+        a pool of part_workers.
+        """
+        src_bucket_name = item.bucket.name
+        if item.size < self.max_copy_size:
+            key = self._bucket.copy_key(item.name, src_bucket_name, item.name,
+                                        metadata=metadata)
+            return key.etag[1:-1]
+
+        part_size = self.multipart_copy_part_size(item.size)
+        mp = self._bucket.initiate_multipart_upload(item.name,
+                                                    metadata=metadata)
+        try:
+            executor = ThreadPoolExecutor(max_workers=self.part_workers)
+            try:
+                futures = [
+                    executor.submit(mp.copy_part_from_key, src_bucket_name,
+                                    item.name, part_num, start,
+                                    min(start + part_size, item.size) - 1)
+                    for part_num, start in enumerate(
+                        range(0, item.size, part_size), 1)]
+                for future in as_completed(futures):
+                    future.result()
+            finally:
+                executor.shutdown()
+            return mp.complete_upload().etag[1:-1]
+        except Exception:
+            mp.cancel_upload()
+            raise
 
-        print('DST MD5: {}'.format(key.etag[1:-1]))
-        if item.etag[1:-1] != key.etag[1:-1]:
-            print('WARNING: source and destination hash don\'t match.')
+    def process(self, item):
+        if self.is_copied(item):
+            raise FilterSkip('File already exists.')
+        src_md5 = item.etag[1:-1]
+
+        # The listing already returns last_modified as an ISO 8601 string.
+        metadata = {self.last_modified: item.last_modified}
+        if self.config.get('server_side_copy'):
+            dst_md5 = self.copy(item, metadata)
+        elif item.size < self.multipart_threshold:
+            dst_md5 = self.upload(item, metadata)
         else:
+            dst_md5 = self.multipart_upload(item, metadata)
+
+        logger.debug('DST MD5: %s', dst_md5)
+        if dst_md5 is None:
+            # The upload couldn't be verified, already reported.
+            return item
+        # A multipart etag is not the md5 of the file, it can't be compared.
+        if '-' not in src_md5 and '-' not in dst_md5 and src_md5 != dst_md5:
+            logger.warning('%s: source and destination hash don\'t match.',
+                           item.name)
+            return item
+        with self._lock:
             self.key_count += 1
+        logger.info('%s copied.', item.name)
         return item
 
     def after_process(self):
@@ -277,6 +565,15 @@ def args_spec():
     parser.add_argument('--dst-region', type=str, action=EnvDefault,
                         envvar='DST_REGION')
 
+    parser.add_argument('--concurrency', type=positive_int, default=16)
+    parser.add_argument('--server-side-copy', action='store_true',
+                        help='Copy keys within the destination endpoint, '
+                             'use it when source and destination are the '
+                             'same S3 service.')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='-v reports every copied key, -vv adds debug '
+                             'details.')
+
     return parser
 
 
@@ -289,18 +586,72 @@ def signal_handler(signal, frame):
     _exit_signal = True
 
 
-def src_keys_generator(conn, bucket_name):
+def src_keys_generator(conn, bucket_name, is_copied=None):
+    """
+    Yield the keys of the source bucket.
+    :param is_copied: callable returning True for the keys already copied,
+        those keys are not yielded. See S3UploadFile.is_copied.
+    """
     for key in conn.get_bucket(bucket_name).list():
         if _exit_signal:
-            raise StopIteration
+            return
+        # The listing includes etag and size, no extra request needed.
+        if is_copied and is_copied(key):
+            continue
         key.name = key.name.encode('utf8')
         yield key
 
 
+def prefetch(items, maxsize=2000):
+    """
+    Iterate items from a background thread. Up to maxsize items are buffered
+    so the producer keeps going (e.g. fetching the next listing page) while
+    the previous items are being processed.
+    Errors raised by the producer are raised again by the consumer.
+    Buffered items are dropped once the user presses Ctrl-C.
+    """
+    buffered = queue.Queue(maxsize=maxsize)
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            for item in items:
+                buffered.put(item)
+        except Exception as ex:
+            errors.append(ex)
+        finally:
+            buffered.put(done)
+
+    producer = threading.Thread(target=produce, name='prefetch')
+    producer.daemon = True
+    producer.start()
+
+    item = buffered.get()
+    while item is not done:
+        if _exit_signal:
+            return
+        yield item
+        item = buffered.get()
+    if errors:
+        raise errors[0]
+
+
 def main():
     parser = args_spec()
     args = parser.parse_args()
 
+    # Only this module is made verbose, boto debug output includes the
+    # request headers.
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.WARNING)
+    logger.setLevel((logging.WARNING, logging.INFO, logging.DEBUG)[
+        min(args.verbose, 2)])
+
+    # One connection per endpoint, shared by every stage and worker thread.
+    # boto keeps a thread safe pool of keep-alive HTTPS connections per
+    # connection object, once warmed up it holds one socket per worker and
+    # requests don't pay for a new TLS handshake.
     src_connection = boto.connect_s3(
         aws_access_key_id=args.src_key_id,
         aws_secret_access_key=args.src_access_key,
@@ -313,32 +664,23 @@ def main():
         args.dst_region,
         aws_access_key_id=args.dst_key_id,
         aws_secret_access_key=args.dst_access_key,
-        host=args.dst_host
+        host=args.dst_host,
+        is_secure=True
     )
 
     signal.signal(signal.SIGINT, signal_handler)
 
-    existing_folders = set()
-    existing_files = dict()
-    dst_bucket = dst_connection.get_bucket(args.dst_bucket)
-    print('Preloading folders:')
-    count = 0
-    for key in dst_bucket.list():
-        sys.stdout.write('.')
-        sys.stdout.flush()
-        count += 1
-        if count == 80:
-            print('')
-            count = 0
-        if _exit_signal:
-            print('User interrupted preload.')
-            sys.exit(0)
-        if key.name.endswith('/'):
-            existing_folders.add(key.name)
-            continue
-        existing_files[key.name] = key.etag[1:-1]
+    dst_index = BucketIndex(
+        dst_connection.get_bucket(args.dst_bucket, validate=False)).load()
+
+    upload = S3UploadFile(connection=dst_connection,
+                          bucket_name=args.dst_bucket,
+                          existing_files=dst_index.files,
+                          server_side_copy=args.server_side_copy)
 
-    p = Pipeline(src_keys_generator(src_connection, args.src_bucket))
+    p = Pipeline(prefetch(src_keys_generator(src_connection,
+                                             args.src_bucket,
+                                             upload.is_copied)))
 
     p.add(PrintFileInfo())
     p.add(Filter('exclude keys with \'default\' in the name',
@@ -346,15 +688,12 @@ def main():
 
     p.add(S3CreateFolderStructure(connection=dst_connection,
                                   bucket_name=args.dst_bucket,
-                                  preload_folders=False,
-                                  existing_folders=existing_folders))
+                                  existing_folders=dst_index.folders))
     p.add(Filter('exclude keys ending in \'/\'',
                  lambda x: x.name.endswith('/')))
-    p.add(S3UploadFile(connection=dst_connection, bucket_name=args.dst_bucket,
-                       existing_files=existing_files))
-    p()
+    p.add(upload)
+    p(workers=args.concurrency)
 
 if __name__ == '__main__':
-    #logging.basicConfig(level=logging.DEBUG)
     main()
 
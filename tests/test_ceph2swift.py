@@ -0,0 +1,300 @@
+import argparse
+import hashlib
+import unittest
+from io import BytesIO
+
+import ceph2swift
+from ceph2swift import (MB, Pipeline, S3CreateFolderStructure, S3UploadFile,
+                        Stage, positive_int, prefetch)
+
+EARLIER = '2017-01-01T00:00:00.000Z'
+LATER = '2017-02-01T00:00:00.000Z'
+
+
+class StubKey(object):
+
+    def __init__(self, name, etag, size, last_modified=EARLIER):
+        self.name = name
+        self.etag = '"{}"'.format(etag)
+        self.size = size
+        self.last_modified = last_modified
+
+
+class StubSourceKey(StubKey):
+
+    def __init__(self, name, data):
+        super(StubSourceKey, self).__init__(
+            name, hashlib.md5(data).hexdigest(), len(data))
+        self.fp = BytesIO(data)
+
+    def read(self, size):
+        return self.fp.read(size)
+
+    def close(self, fast=False):
+        pass
+
+
+class StubMultiPartUpload(object):
+
+    def __init__(self, corrupt, fail):
+        self.corrupt = corrupt
+        self.fail = fail
+        self.parts = {}
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        if self.fail:
+            raise IOError('part upload failed')
+        self.parts[part_num] = hashlib.md5(fp.read()).digest()
+
+    def complete_upload(self):
+        parts = [self.parts[n] for n in sorted(self.parts)]
+        if self.corrupt:
+            parts.reverse()
+        return StubKey(None, '{}-{}'.format(
+            hashlib.md5(b''.join(parts)).hexdigest(), len(parts)), None)
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+class StubBucket(object):
+
+    def __init__(self, corrupt=False, fail=False):
+        self.mp = StubMultiPartUpload(corrupt, fail)
+
+    def initiate_multipart_upload(self, name, metadata=None):
+        return self.mp
+
+
+class StubFolderKey(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.metadata = {}
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def set_contents_from_string(self, data):
+        if self.name in self.bucket.fail:
+            raise IOError('PUT failed')
+        self.bucket.created.append(self.name)
+
+
+class StubFolderBucket(object):
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.created = []
+
+    def new_key(self, name):
+        return StubFolderKey(self, name)
+
+
+class FolderStructureTest(unittest.TestCase):
+
+    def stage(self, existing_folders, bucket):
+        stage = S3CreateFolderStructure(existing_folders=existing_folders)
+        stage._bucket = bucket
+        return stage
+
+    def test_sub_folders(self):
+        stage = S3CreateFolderStructure()
+        self.assertEqual(stage.sub_folders('a/b/c'), ['a/', 'a/b/'])
+        self.assertEqual(stage.sub_folders('a'), [])
+        self.assertEqual(stage.sub_folders('a/'), ['a/'])
+        self.assertEqual(stage.sub_folders('a//b'), ['a/', 'a//'])
+        self.assertEqual(stage.sub_folders('/a/b'), ['/', '/a/'])
+
+    def test_creates_missing_parents_first(self):
+        bucket = StubFolderBucket()
+        stage = self.stage({'a/'}, bucket)
+        stage.process(StubSourceKey('a/b/c/d', b''))
+        self.assertEqual(bucket.created, ['a/b/', 'a/b/c/'])
+        self.assertEqual(stage.existing_folders, {'a/', 'a/b/', 'a/b/c/'})
+
+    def test_existing_folders_are_not_created_again(self):
+        bucket = StubFolderBucket()
+        stage = self.stage(set(), bucket)
+        stage.process(StubSourceKey('a/b/c', b''))
+        stage.process(StubSourceKey('a/b/d', b''))
+        self.assertEqual(bucket.created, ['a/', 'a/b/'])
+
+    def test_failed_folder_is_released(self):
+        bucket = StubFolderBucket(fail=['a/b/'])
+        stage = self.stage(set(), bucket)
+        with self.assertRaises(IOError):
+            stage.process(StubSourceKey('a/b/c', b''))
+        self.assertEqual(stage.existing_folders, {'a/'})
+
+
+class IsCopiedTest(unittest.TestCase):
+
+    def stage(self, existing_files, **kwargs):
+        return S3UploadFile(existing_files=existing_files, **kwargs)
+
+    def test_missing_file(self):
+        stage = self.stage({})
+        self.assertFalse(stage.is_copied(StubKey('a', 'abc', 1)))
+
+    def test_same_etag(self):
+        stage = self.stage({'a': ('abc', 1, LATER)})
+        self.assertTrue(stage.is_copied(StubKey('a', 'abc', 1)))
+
+    def test_different_etag(self):
+        stage = self.stage({'a': ('def', 1, LATER)})
+        self.assertFalse(stage.is_copied(StubKey('a', 'abc', 1)))
+
+    def test_multipart_copy_of_single_part_source(self):
+        size = 25 * MB
+        stage = self.stage({'a': ('def-3', size, LATER)})
+        self.assertTrue(stage.is_copied(StubKey('a', 'abc', size)))
+
+    def test_multipart_copy_with_other_part_count(self):
+        size = 25 * MB
+        stage = self.stage({'a': ('def-2', size, LATER)})
+        self.assertFalse(stage.is_copied(StubKey('a', 'abc', size)))
+
+    def test_multipart_copy_with_other_size(self):
+        stage = self.stage({'a': ('def-3', 25 * MB, LATER)})
+        self.assertFalse(stage.is_copied(StubKey('a', 'abc', 26 * MB)))
+
+    def test_source_rewritten_with_the_same_size(self):
+        size = 25 * MB
+        stage = self.stage({'a': ('def-3', size, EARLIER)})
+        self.assertFalse(stage.is_copied(StubKey('a', 'abc', size, LATER)))
+
+    def test_server_side_multipart_copy(self):
+        size = 6 * 1024 * MB
+        stage = self.stage({'a': ('def-12', size, LATER)},
+                           server_side_copy=True)
+        self.assertTrue(stage.is_copied(StubKey('a', 'abc', size)))
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+    def upload(self, bucket):
+        stage = S3UploadFile(existing_files={})
+        stage.multipart_threshold = 1
+        stage.part_size = 4
+        stage._bucket = bucket
+        stage.process(StubSourceKey('big', b'0123456789'))
+        return stage
+
+    def test_verified_upload_is_counted(self):
+        bucket = StubBucket()
+        stage = self.upload(bucket)
+        self.assertEqual(len(bucket.mp.parts), 3)
+        self.assertEqual(stage.key_count, 1)
+
+    def test_etag_mismatch_is_not_counted(self):
+        stage = self.upload(StubBucket(corrupt=True))
+        self.assertEqual(stage.key_count, 0)
+
+    def assertPartsReleased(self, stage):
+        for _ in range(stage.max_parts_in_memory):
+            self.assertTrue(stage._parts_in_memory.acquire(False))
+        self.assertFalse(stage._parts_in_memory.acquire(False))
+
+    def test_parts_are_released_after_upload(self):
+        self.assertPartsReleased(self.upload(StubBucket()))
+
+    def test_parts_are_released_after_failure(self):
+        bucket = StubBucket(fail=True)
+        stage = S3UploadFile(existing_files={})
+        stage.multipart_threshold = 1
+        stage.part_size = 4
+        stage._bucket = bucket
+        with self.assertRaises(IOError):
+            stage.process(StubSourceKey('big', b'0123456789'))
+        self.assertTrue(bucket.mp.cancelled)
+        self.assertPartsReleased(stage)
+
+
+class PartSizeTest(unittest.TestCase):
+
+    def test_default_part_size(self):
+        stage = S3UploadFile(existing_files={})
+        self.assertEqual(stage.multipart_part_size(100 * MB), 10 * MB)
+
+    def test_part_size_grows_past_max_parts(self):
+        stage = S3UploadFile(existing_files={})
+        size = 200 * 1024 * MB
+        part_size = stage.multipart_part_size(size)
+        self.assertLessEqual(-(-size // part_size), stage.max_parts)
+
+    def test_copy_part_size_grows_past_max_parts(self):
+        stage = S3UploadFile(existing_files={}, server_side_copy=True)
+        size = 5 * 1024 * 1024 * MB
+        part_size = stage.multipart_copy_part_size(size)
+        self.assertLessEqual(-(-size // part_size), stage.max_parts)
+        self.assertEqual(stage.parts_count(size), -(-size // part_size))
+
+
+class FailingStage(Stage):
+
+    finished = False
+
+    def process(self, item):
+        if item.name == 'bad':
+            raise ValueError('boom')
+        return item
+
+    def after_process(self):
+        self.finished = True
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_stage_error_is_raised_after_the_summaries(self):
+        stage = FailingStage()
+        p = Pipeline([StubKey(name, 'abc', 1) for name in ('a', 'bad', 'c')])
+        p.add(stage)
+        with self.assertRaises(ValueError):
+            p(workers=2)
+        self.assertTrue(stage.finished)
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def tearDown(self):
+        ceph2swift._exit_signal = False
+
+    def test_yields_every_item(self):
+        self.assertEqual(list(prefetch(iter(range(100)), maxsize=5)),
+                         list(range(100)))
+
+    def test_stops_on_exit_signal(self):
+        items = prefetch(iter(range(100)), maxsize=50)
+        self.assertEqual(next(items), 0)
+        ceph2swift._exit_signal = True
+        self.assertEqual(list(items), [])
+
+
+class PositiveIntTest(unittest.TestCase):
+
+    def test_positive(self):
+        self.assertEqual(positive_int('4'), 4)
+
+    def test_zero_and_negative(self):
+        for value in ('0', '-1'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                positive_int(value)
+
+    def test_concurrency_is_validated(self):
+        parser = ceph2swift.args_spec()
+        args = ['--src-bucket', 'a', '--dst-bucket', 'b']
+        for option in ('src-key-id', 'src-access-key', 'src-host',
+                       'dst-key-id', 'dst-access-key', 'dst-host',
+                       'dst-region'):
+            args += ['--' + option, 'x']
+        self.assertEqual(
+            parser.parse_args(args + ['--concurrency', '2']).concurrency, 2)
+        with self.assertRaises(SystemExit):
+            parser.parse_args(args + ['--concurrency', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()